@@ -1,23 +1,30 @@
 import os
-import json
 import time
+import asyncio
 import csv
-import math
+import functools
 import random
+import shutil
+from contextlib import ExitStack
 from pathlib import Path
-from statistics import mean
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from elasticsearch import Elasticsearch
+import numpy as np
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.serializer import OrjsonSerializer
+from query_utils import build_kwargs, list_query_files, load_json, total_hits_from
 
 # Settings
 ES_URL = os.getenv("ELASTIC_URL", "http://localhost:9200")
 INDEX_NAME = os.getenv("INDEX_NAME", "amazon-music-reviews")
-QUERY_DIR = os.getenv("QUERY_DIR", "../queries")
-OUT_DIR = os.getenv("OUT_DIR", "../scenarios_outputs")
+QUERY_DIR = os.getenv("QUERY_DIR", "queries")
+OUT_DIR = os.getenv("OUT_DIR", "scenarios_outputs")
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "180"))  # seconds
 DURATION_PER_CLIENT = float(os.getenv("DURATION_PER_CLIENT", "10"))  # seconds
 WARMUP_REQUESTS = int(os.getenv("WARMUP_REQUESTS", "5"))
 RANDOM_SEED = int(os.getenv("SEED", "42"))
+CONNECTIONS_PER_NODE = int(os.getenv("CONNECTIONS_PER_NODE", "32"))  # HTTP pool size per ES node
+LOG_BUFFER_BYTES = 256 * 1024  # write buffer of each per-request log file
+
+PER_REQ_HEADER = ["scenario", "query", "epoch", "latency_s", "took_ms", "total_hits", "status"]
 
 # changing the number of clients in each scenario(the choice of queries are all random)
 SCENARIOS = [
@@ -36,119 +43,116 @@ SCENARIOS = [
 random.seed(RANDOM_SEED)
 
 
-# Set query parameters for ElasticSearch client
+# Load every query file as (file name, search kwargs)
 def load_query_files(qdir: Path):
-    files = sorted([p for p in qdir.glob("*.json")])
-    queries = []
-    for p in files:
-        with p.open("r", encoding="utf-8") as f:
-            q = json.load(f)
-        # ES 9.x named-args
-        kw = {}
-        if "query" in q:
-            kw["query"] = q["query"]
-        if "aggs" in q:
-            kw["aggs"] = q["aggs"]
-        if "size" in q:
-            kw["size"] = q["size"]
-        if "sort" in q:
-            kw["sort"] = q["sort"]
-        if "_source" in q:
-            kw["_source"] = q["_source"]
-        if "from" in q:
-            kw["from_"] = q["from"]
-        kw["track_total_hits"] = q.get("track_total_hits", True)
-        queries.append((p.name, kw))
-    return queries
-
-
-# getting the percentile of times
-def percentile(values, p):
-    if not values:
-        return None
-    s = sorted(values)
-    k = (len(s) - 1) * (p / 100.0)
-    f = math.floor(k)
-    c = math.ceil(k)
-    if f == c:
-        return s[int(k)]
-    return s[f] + (s[c] - s[f]) * (k - f)
-
-
-# Sending random request by clients
-def run_client(es: Elasticsearch, queries, duration_s, per_req_rows, scenario_name):
+    # frozen: the list is only ever indexed from here on
+    return tuple((p.name, build_kwargs(load_json(p))) for p in list_query_files(qdir))
+
+
+# (file name, es.search with the index and the query's kwargs already bound) per query
+def bind_searches(es: AsyncElasticsearch, queries):
+    return tuple((qname, functools.partial(es.search, index=INDEX_NAME, **kw)) for qname, kw in queries)
+
+
+# p50/p90/p95/p99 of the samples in a single sort (empty cells when there are no samples)
+def percentiles(arr: np.ndarray):
+    if not arr.size:
+        return [""] * 4
+    return [round(float(v), 2) for v in np.percentile(arr, [50, 90, 95, 99])]
+
+
+# Sending random request by clients (each client is a coroutine on the same event loop).
+# Every request is streamed to the client's own csv writer; only the numbers needed
+# for the summary are kept in memory and returned.
+async def run_client(queries, duration_s, writer, scenario_name):
+    stats = {"requests": 0, "success": 0, "latencies": [], "tooks_ms": []}
+    # all clients share one thread, so the module-level generator is not contended
+    n = len(queries)
+    rand = random.randrange
     start_time = time.perf_counter()
     while (time.perf_counter() - start_time) < duration_s:
-        qname, kwargs = random.choice(queries)
+        qname, do_search = queries[rand(n)]
         t0 = time.perf_counter()
         status = "Success"
         took = ""
         total_hits = ""
         try:
-            res = es.search(index=INDEX_NAME, **kwargs)
+            res = await do_search()
             res_body = res.body
             took = res_body.get("took", "")
-            th = res_body.get("hits", {}).get("total", 0)
-            total_hits = th.get("value", th if isinstance(th, int) else "")
+            total_hits = total_hits_from(res_body)
         except Exception as e:
             status = f"{type(e).__name__}: {e}"
         latency = (time.perf_counter() - t0)
-        per_req_rows.append([
-            scenario_name, qname, time.time(), latency, took, total_hits, status
-        ])
+        writer.writerow([scenario_name, qname, time.time(), latency, took, total_hits, status])
+
+        stats["requests"] += 1
+        if status == "Success":
+            stats["success"] += 1
+            stats["latencies"].append(latency)
+            if isinstance(took, (int, float)):
+                stats["tooks_ms"].append(took)
+    return stats
 
 
 # some simple queries to warm up
-def warmup(es: Elasticsearch, queries):
+async def warmup(queries):
     n = min(WARMUP_REQUESTS, len(queries))
     for i in range(n):
         try:
-            _, kwargs = queries[i]
-            es.search(index=INDEX_NAME, **kwargs)
+            _, do_search = queries[i]
+            await do_search()
         except Exception:
             pass
 
 
-def run_scenario(es: Elasticsearch, scenario, queries, outdir: Path):
+async def run_scenario(es: AsyncElasticsearch, scenario, queries, outdir: Path):
     name = scenario["name"]
     clients = scenario["clients"]
 
     # erase the cache to start fair
     try:
-        es.indices.clear_cache(index=INDEX_NAME)
+        await es.indices.clear_cache(index=INDEX_NAME)
     except Exception:
         pass
 
-    warmup(es, queries)
+    await warmup(queries)
 
-    per_req_rows = []  # [scenario, query_name, epoch, latency_s, took_ms, total_hits, status]
-
-    t0 = time.perf_counter()
-    with ThreadPoolExecutor(max_workers=clients) as ex:
-        futures = [ex.submit(run_client, es, queries, DURATION_PER_CLIENT, per_req_rows, name)
-                   for _ in range(clients)]
-        for _ in as_completed(futures):
-            pass
-    elapsed = time.perf_counter() - t0
-
-    # log each request
+    # log each request: one buffered file per client, merged once the scenario is over
     per_req_dir = outdir / "per_request_logs"
     per_req_dir.mkdir(parents=True, exist_ok=True)
+    client_files = [per_req_dir / f"{name}__client{i}.csv" for i in range(clients)]
+
+    with ExitStack() as stack:
+        writers = [
+            csv.writer(stack.enter_context(
+                open(path, "w", buffering=LOG_BUFFER_BYTES, newline="", encoding="utf-8")))
+            for path in client_files
+        ]
+        t0 = time.perf_counter()
+        client_stats = await asyncio.gather(*[run_client(queries, DURATION_PER_CLIENT, w, name)
+                                              for w in writers])
+        elapsed = time.perf_counter() - t0
+
     per_req_file = per_req_dir / f"{name}.csv"
     with per_req_file.open("w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["scenario", "query", "epoch", "latency_s", "took_ms", "total_hits", "status"])
-        w.writerows(per_req_rows)
+        csv.writer(f).writerow(PER_REQ_HEADER)
+        for path in client_files:
+            with path.open("r", newline="", encoding="utf-8") as src:
+                shutil.copyfileobj(src, f, LOG_BUFFER_BYTES)
+            path.unlink()
 
     # set the results
-    latencies = [r[3] for r in per_req_rows if r[6] == "Success"]
-    tooks_ms = [r[4] for r in per_req_rows if r[6] == "Success" and isinstance(r[4], (int, float))]
-    total_requests = len(per_req_rows)
-    success = sum(1 for r in per_req_rows if r[6] == "Success")
+    lat_ms = np.concatenate([np.asarray(st["latencies"], dtype=np.float64) for st in client_stats]) * 1000
+    tooks_ms = np.concatenate([np.asarray(st["tooks_ms"], dtype=np.float64) for st in client_stats])
+    total_requests = sum(st["requests"] for st in client_stats)
+    success = sum(st["success"] for st in client_stats)
     errors = total_requests - success
     rps = total_requests / elapsed if elapsed > 0 else 0.0
 
     # calculate latencies and percentile to log in the csv file
+    lat_p50, lat_p90, lat_p95, lat_p99 = percentiles(lat_ms)
+    took_p95 = percentiles(tooks_ms)[2]
     summary = {
         "scenario": name,
         "clients": clients,
@@ -157,38 +161,53 @@ def run_scenario(es: Elasticsearch, scenario, queries, outdir: Path):
         "success": success,
         "errors": errors,
         "rps": round(rps, 2),
-        "lat_avg_ms": round(mean(latencies) * 1000, 2) if latencies else "",
-        "lat_p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else "",
-        "lat_p90_ms": round(percentile(latencies, 90) * 1000, 2) if latencies else "",
-        "lat_p95_ms": round(percentile(latencies, 95) * 1000, 2) if latencies else "",
-        "lat_p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else "",
-        "took_avg_ms": round(mean(tooks_ms), 2) if tooks_ms else "",
-        "took_p95_ms": round(percentile(tooks_ms, 95), 2) if tooks_ms else "",
+        "lat_avg_ms": round(float(lat_ms.mean()), 2) if lat_ms.size else "",
+        "lat_p50_ms": lat_p50,
+        "lat_p90_ms": lat_p90,
+        "lat_p95_ms": lat_p95,
+        "lat_p99_ms": lat_p99,
+        "took_avg_ms": round(float(tooks_ms.mean()), 2) if tooks_ms.size else "",
+        "took_p95_ms": took_p95,
     }
     return summary
 
 
-def main():
+async def main():
     qdir = Path(QUERY_DIR)
     outdir = Path(OUT_DIR)
     outdir.mkdir(parents=True, exist_ok=True)
     if not qdir.exists():
         raise SystemExit(f"Query directory not found: {qdir.resolve()}")
 
-    # ElasticSearch client with global timeout
-    es = Elasticsearch(ES_URL).options(request_timeout=REQUEST_TIMEOUT)
-
     # loading queries from the directory
     queries = load_query_files(qdir)
     if not queries:
         raise SystemExit("No queries found.")
 
+    # Async ElasticSearch client with global timeout; responses are parsed with orjson.
+    # The HTTP pool must hold at least one connection per client, otherwise requests
+    # queue up for a free socket and the bigger scenarios are not really parallel.
+    max_clients = max(sc["clients"] for sc in SCENARIOS)
+    es = AsyncElasticsearch(
+        ES_URL,
+        request_timeout=REQUEST_TIMEOUT,
+        serializer=OrjsonSerializer(),
+        connections_per_node=max(CONNECTIONS_PER_NODE, max_clients),
+    )
+
+    # bind every query to es.search once, so the request loop is a single call
+    queries = bind_searches(es, queries)
+
     summaries = []
-    for sc in SCENARIOS:
-        print(f"Running scenario: {sc['name']}  (clients={sc['clients']}, selector=random)")
-        s = run_scenario(es, sc, queries, outdir)
-        summaries.append(s)
-        print(f"  -> done in {s['duration_s']}s | rps={s['rps']} | avg_lat={s['lat_avg_ms']} ms | errors={s['errors']}")
+    try:
+        for sc in SCENARIOS:
+            print(f"Running scenario: {sc['name']}  (clients={sc['clients']}, selector=random)")
+            s = await run_scenario(es, sc, queries, outdir)
+            summaries.append(s)
+            print(f"  -> done in {s['duration_s']}s | rps={s['rps']} | avg_lat={s['lat_avg_ms']} ms | errors={s['errors']}")
+    finally:
+        # close the aiohttp session, otherwise it warns about an unclosed session
+        await es.close()
 
     # output the results in scenarios_report.csv
     summary_csv = outdir / "scenarios_report.csv"
@@ -207,4 +226,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
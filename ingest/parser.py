@@ -33,7 +33,7 @@ Design goals:
     - Never raise on bad rows: coerce to None where appropriate.
     - Keep raw helpfulness as reference, but also provide a normalized float.
 """
-from datetime import datetime, timezone
+import time
 
 # Mapping from raw SNAP keys to our normalized document keys.
 KEYS = {
@@ -49,49 +49,62 @@ KEYS = {
     "review/text": "review_text",
 }
 
+# First epoch second that datetime can no longer represent (year 10000)
+_MAX_EPOCH = 253402300800
+# Longest digit strings handed to int(): enough for any real epoch / vote count, and far
+# below the 4300-digit limit past which int() raises ValueError
+_MAX_EPOCH_DIGITS = len(str(_MAX_EPOCH))
+_MAX_COUNT_DIGITS = 18
+
+
+def _to_float(s):
+    """Plain decimal string ("15.99", "-3", "5.0") -> float, anything else -> None."""
+    if not s or not isinstance(s, str):
+        return None
+    digits = s[1:] if s[0] == "-" else s
+    return float(s) if digits.replace(".", "", 1).isdecimal() else None
+
 
 def normalize(block: dict) -> dict:
     d = {}
 
     # Map and copy raw values from the input block into d
-    for k, v in block.items():
-        if k in KEYS:
+    for raw_key, key in KEYS.items():
+        v = block.get(raw_key)
+        if v is not None:
             # strip whitespace if value is a string, otherwise keep the format
-            d[KEYS[k]] = v.strip() if isinstance(v, str) else v
+            d[key] = v.strip() if isinstance(v, str) else v
+
+    # The cheap string checks below replace try/except: malformed values become None
+    # without going through the exception machinery on every bad row.
 
     # Price -> float or None
-    try:
-        d["price"] = float(d.get("price")) if d.get("price") not in (None, "") else None
-    except:
-        d["price"] = None
+    d["price"] = _to_float(d.get("price"))
 
     # Score -> float or None
-    try:
-        d["score"] = float(d.get("score")) if d.get("score") not in (None, "") else None
-    except:
-        d["score"] = None
+    d["score"] = _to_float(d.get("score"))
 
     # Time -> int epoch + derived ISO UTC string
-    try:
-        t = int(d.get("time"))
+    t = d.get("time")
+    t = int(t) if isinstance(t, str) and len(t) <= _MAX_EPOCH_DIGITS and t.isdecimal() else None
+    if t is not None and t < _MAX_EPOCH:
         d["time"] = t
-        d["time_iso"] = datetime.fromtimestamp(t, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
-    except:
+        d["time_iso"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(t))
+    else:
         # If invalid, nullify both fields
         d["time"] = None
         d["time_iso"] = None
 
     # Helpfulness "x/y" -> float ratio or None
+    d["helpfulness"] = None
     h = d.get("helpfulness_raw")
-    if h:
-        try:
-            num, den = h.split("/")
-            num, den = int(num), int(den)
+    if h and isinstance(h, str):
+        num, sep, den = h.partition("/")
+        if (sep and len(num) <= _MAX_COUNT_DIGITS and len(den) <= _MAX_COUNT_DIGITS
+                and num.isdecimal() and den.isdecimal()):
+            den = int(den)
             # Only compute ratio if denominator > 0
-            d["helpfulness"] = (num / den) if den > 0 else None
-        except:
-            d["helpfulness"] = None
-    else:
-        d["helpfulness"] = None
+            if den > 0:
+                d["helpfulness"] = int(num) / den
 
     return d
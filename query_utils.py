@@ -0,0 +1,48 @@
+# Query-file helpers shared by run_queries.py and benchmark/load_scenarios.py.
+# Kept free of the Elasticsearch client and the scripts' env-driven settings.
+import os
+from pathlib import Path
+import orjson
+
+
+# Convert json queries to dicts
+def load_json(p: Path):
+    return orjson.loads(p.read_bytes())
+
+
+# Sorted *.json files of the query directory
+# (scandir hands back the entry type with the listing, no extra stat per file)
+def list_query_files(qdir: Path):
+    return sorted(Path(e.path) for e in os.scandir(qdir) if e.is_file() and e.name.endswith(".json"))
+
+
+# Extract hits.total.value from response
+# ("" when the query does not track totals, "N+" when counting stopped at a lower bound N)
+def total_hits_from(res_body: dict):
+    th = res_body.get("hits", {}).get("total")
+    if th is None:
+        return ""
+    if isinstance(th, dict):
+        value = int(th.get("value", 0))
+        return f"{value}+" if th.get("relation") == "gte" else value
+    return int(th)
+
+
+# Set query parameters for ElasticSearch client
+def build_kwargs(q: dict) -> dict:
+    kw = {}
+    if "query" in q:
+        kw["query"] = q["query"]
+    if "aggs" in q:
+        kw["aggs"] = q["aggs"]
+    if "size" in q:
+        kw["size"] = q["size"]
+    if "sort" in q:
+        kw["sort"] = q["sort"]
+    if "_source" in q:
+        kw["_source"] = q["_source"]
+    if "from" in q:
+        kw["from_"] = q["from"]  # ES Python client uses from_
+    # counting every match is expensive, so only queries that ask for it pay for it
+    kw["track_total_hits"] = q.get("track_total_hits", False)
+    return kw
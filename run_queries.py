@@ -1,8 +1,13 @@
 import os
-import json
+import argparse
 import csv
+import hashlib
 from pathlib import Path
+import orjson
+import zstandard as zstd
 from elasticsearch import Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer
+from query_utils import build_kwargs, list_query_files, load_json, total_hits_from
 
 # Config
 ES_URL = os.getenv("ELASTIC_URL", "http://localhost:9200")
@@ -11,50 +16,38 @@ QUERY_DIR = os.getenv("QUERY_DIR", "queries")
 CSV_REPORT = os.getenv("CSV_REPORT", "queries_report.csv")
 OUT_DIR = os.getenv("OUT_DIR", "queries_outputs")
 REQUEST_TIMEOUT = float(os.getenv("REQUEST_TIMEOUT", "180"))
+PRETTY = os.getenv("PRETTY", "").lower() not in ("", "0", "false", "no")  # indent the saved responses (slower, bigger files)
+DUMP_OPTIONS = orjson.OPT_INDENT_2 if PRETTY else 0
+ZSTD_LEVEL = int(os.getenv("ZSTD_LEVEL", "3"))  # responses are stored as .json.zst
 
 
-# Convert json queries to dicts
-def load_json(p: Path):
-    with p.open("r", encoding="utf-8") as f:
-        return json.load(f)
+# Fingerprint of what is sent for a query; a cached response is reused while it matches
+def query_hash(body: dict) -> str:
+    key = orjson.dumps({"index": INDEX_NAME, "body": body}, option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(key, digest_size=16).hexdigest()
 
 
-# Extract hits.total.value from response
-def total_hits_from(res_body: dict) -> int:
-    th = res_body.get("hits", {}).get("total", 0)
-    if isinstance(th, dict):
-        return int(th.get("value", 0))
-    return int(th or 0)
-
-
-# Set query parameters for ElasticSearch client
-def build_kwargs(q: dict) -> dict:
-    kw = {}
-    if "query" in q:
-        kw["query"] = q["query"]
-    if "aggs" in q:
-        kw["aggs"] = q["aggs"]
-    if "size" in q:
-        kw["size"] = q["size"]
-    if "sort" in q:
-        kw["sort"] = q["sort"]
-    if "_source" in q:
-        kw["_source"] = q["_source"]
-    if "from" in q:
-        kw["from_"] = q["from"]  # ES Python client uses from_
-    kw["track_total_hits"] = q.get("track_total_hits", True)
-    return kw
+# Sidecar of a cached response: query hash plus the numbers that go into the report
+def load_meta(path: Path):
+    try:
+        return orjson.loads(path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return None
 
 
 def main():
+    p = argparse.ArgumentParser(description="Run every query file once and save the responses")
+    p.add_argument("--force", action="store_true", help="Re-run queries even if their cached response is current")
+    args = p.parse_args()
+
     qdir = Path(QUERY_DIR)
     outdir = Path(OUT_DIR)
     outdir.mkdir(parents=True, exist_ok=True)
     if not qdir.exists():
         raise SystemExit(f"Query directory not found: {qdir.resolve()}")
 
-    # ES client with global timeout
-    es = Elasticsearch(ES_URL).options(request_timeout=REQUEST_TIMEOUT)
+    # ES client with global timeout; responses are parsed with orjson
+    es = Elasticsearch(ES_URL, serializer=OrjsonSerializer()).options(request_timeout=REQUEST_TIMEOUT)
 
     # Clear cache before running
     try:
@@ -63,8 +56,47 @@ def main():
     except Exception as e:
         print(f"WARNING: clear_cache failed: {type(e).__name__}: {e}")
 
-    qfiles = sorted(qdir.glob("*.json"))
-
+    qfiles = list_query_files(qdir)
+
+    # Load every query up front so they can be sent in a single msearch call.
+    # Files that fail to load keep their error as status and are left out of the batch,
+    # so are queries whose saved response was produced by the very same request.
+    load_errors = {}
+    cached = {}
+    hashes = {}
+    batch_files = []
+    searches = []
+    for qp in qfiles:
+        try:
+            q = load_json(qp)
+            body = build_kwargs(q)
+            if "from_" in body:
+                body["from"] = body.pop("from_")  # msearch bodies use the raw ES key
+        except Exception as e:
+            load_errors[qp] = f"{type(e).__name__}: {e}"
+            continue
+        hashes[qp] = query_hash(body)
+        if not args.force:
+            meta = load_meta(outdir / f"{qp.stem}_response.meta.json")
+            if (meta and meta.get("query_hash") == hashes[qp]
+                    and (outdir / f"{qp.stem}_response.json.zst").exists()):
+                cached[qp] = meta
+                continue
+        batch_files.append(qp)
+        searches.append({"index": INDEX_NAME})
+        searches.append(body)
+
+    # performing all queries in one round-trip
+    responses = {}
+    if searches:
+        try:
+            res = es.msearch(searches=searches)
+            responses = dict(zip(batch_files, res.body["responses"]))
+        except Exception as e:
+            status = f"{type(e).__name__}: {e}"
+            load_errors.update({qp: status for qp in batch_files})
+
+    cctx = zstd.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
     with open(CSV_REPORT, "w", newline="", encoding="utf-8") as fcsv:
         writer = csv.writer(fcsv)
         writer.writerow(["Query", "Took(ms)", "TotalHits", "Status"])
@@ -72,26 +104,39 @@ def main():
         for qp in qfiles:
             took_ms, total_hits, status = "", "", "Success"
             try:
-                # loading the query
-                q = load_json(qp)
-                # setting arguments
-                kwargs = build_kwargs(q)
-
-                # performing the query
-                res = es.search(index=INDEX_NAME, **kwargs)
-                res_body: dict = res.body
-
-                took_ms = res_body.get("took", "")
-                total_hits = total_hits_from(res_body)
-
-                # save raw response body
-                out_path = outdir / f"{qp.stem}_response.json"
-                with out_path.open("w", encoding="utf-8") as outf:
-                    json.dump(res_body, outf, ensure_ascii=False, indent=2)
+                if qp in load_errors:
+                    status = load_errors[qp]
+                elif qp in cached:
+                    took_ms = cached[qp].get("took", "")
+                    total_hits = cached[qp].get("total_hits", "")
+                    status = "Cached"
+                else:
+                    res_body: dict = responses[qp]
+                    if "error" in res_body:
+                        err = res_body["error"]
+                        if isinstance(err, dict):
+                            status = f"{err.get('type', 'error')}: {err.get('reason', '')}"
+                        else:
+                            status = f"error: {err}"
+                    else:
+                        took_ms = res_body.get("took", "")
+                        total_hits = total_hits_from(res_body)
+
+                        # save raw response body, zstd-compressed; the sidecar is written last
+                        # so it never points at a half-written response
+                        out_path = outdir / f"{qp.stem}_response.json.zst"
+                        out_path.write_bytes(cctx.compress(orjson.dumps(res_body, option=DUMP_OPTIONS)))
+                        meta = {"query_hash": hashes[qp], "took": took_ms, "total_hits": total_hits}
+                        (outdir / f"{qp.stem}_response.meta.json").write_bytes(orjson.dumps(meta))
 
             except Exception as e:
                 status = f"{type(e).__name__}: {e}"
 
+            # a failed run must not leave an older response behind to be reported as Cached
+            if status not in ("Success", "Cached"):
+                for stale in (f"{qp.stem}_response.meta.json", f"{qp.stem}_response.json.zst"):
+                    (outdir / stale).unlink(missing_ok=True)
+
             writer.writerow([qp.name, took_ms, total_hits, status])
             print(f"{qp.name:35} | took={took_ms} ms | total hits={total_hits} | {status}")
 